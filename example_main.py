@@ -11,11 +11,14 @@ embedded in comments below labeled with STEP X OF X.
 import riptimize
 import datetime
 import csv
-import boto
+import io
+from concurrent.futures import ThreadPoolExecutor
+import botocore.exceptions
+from boto3.s3.transfer import TransferConfig
 
 def main():
-    print "Example Riptimize Driver"
-    print
+    print("Example Riptimize Driver")
+    print()
 
     # 1. setup
     # STEP 1 of 7: specify region
@@ -40,149 +43,173 @@ def main():
 
     # STEP 6 of 7: Leaving as True will upload the CSV report to S3 for safekeeping
     upload_report = True # CSV reports will be saved in S3 in s3_report_bucket
-    s3_report_bucket = "riptimize-reports-%s" % ri_account_id
+    s3_report_bucket = f"riptimize-reports-{ri_account_id}"
 
     # 2. do it
     # STEP 7 of 7: Ok, you are ready to go, just execute on the command line % python example_main.py 
-    riptimize_result_tuple = riptimize.riptimize(all_accounts, ri_account_credentials, region, optimize, publish_metrics)
+    # metrics are published below, alongside writing and uploading the report, rather than by riptimize() itself
+    riptimize_result_tuple = riptimize.riptimize(all_accounts, ri_account_credentials, region, optimize, publish_metrics=False)
 
     # 3. show results
-    i_inventory, i_inventory_by_account, ri_inventory, supported_ri_zones, processing_modifications, clean_mismatch, recommendations, plan, modification_ids = riptimize_result_tuple
+    i_inventory, i_inventory_by_account, ri_inventory, supported_ri_zones, processing_modifications, clean_mismatch, recommendations, plan, modification_ids, ri_surplus = riptimize_result_tuple
 
     time_now = datetime.datetime.utcnow()
-    print "Report for region %s as of %s" % (region, time_now)
-    print
+    print(f"Report for region {region} as of {time_now}")
+    print()
     # 3.1 print on-demand instance inventory
-    print "Instance Inventory by account:"
-    print i_inventory_by_account
-    print
-    print "Aggregate instance inventory:"
-    print i_inventory
-    print
+    print("Instance Inventory by account:")
+    print(i_inventory_by_account)
+    print()
+    print("Aggregate instance inventory:")
+    print(i_inventory)
+    print()
     # 3.2 print RI inventory
-    print "RI Inventory:"
-    print ri_inventory
-    print
+    print("RI Inventory:")
+    print(ri_inventory)
+    print()
     # 3.3 show all supported AZs in the RI holding account
-    print "Supported RI zones: " + str(supported_ri_zones)
+    print("Supported RI zones: " + str(sorted(supported_ri_zones)))
     # 3.4 show if previous modifications are still being executed
     modifications_inflight = len(processing_modifications) != 0
     if modifications_inflight:
-        print
-        print "======--- WARNING ---======"
-        print "Previous modifications are still processing:"
+        print()
+        print("======--- WARNING ---======")
+        print("Previous modifications are still processing:")
         for mod in processing_modifications:
-            print "modification_id: %s, status: %s" % (mod.modification_id, mod.status)
-        print "!!! RI optimizations cannot be performed until previous modifications are completed"
-        print "!!! RI inventory and recommendations will also be potentially incorrect"
-    print
+            print(f"modification_id: {mod['ReservedInstancesModificationId']}, status: {mod['Status']}")
+        print("!!! RI optimizations cannot be performed until previous modifications are completed")
+        print("!!! RI inventory and recommendations will also be potentially incorrect")
+    print()
     # 3.5 print detected mismatches between numbers of on-demand running instances and RIs by availability zone and instance type
     if len(clean_mismatch) > 0:
-        print "On-demand/RI inventory mismatches per availability zone:"
-        print clean_mismatch
+        print("On-demand/RI inventory mismatches per availability zone:")
+        print(clean_mismatch)
     else:
-        print "No On-demand/RI inventory mimatches detected in any availability zones:"
-    print
+        print("No On-demand/RI inventory mimatches detected in any availability zones:")
+    print()
     # 3.6 print recommendations for migrating running instances into AZs covered by RI holding account, purchasing additional RIs or launching additional instances to get better RI utilization
     eliminated_i_inventory, ri_imbalance = recommendations
     if len(eliminated_i_inventory) == 0 and len(ri_imbalance) == 0:
-        print "No recomendations available"
+        print("No recomendations available")
     else:
-        print "Recommendations:"
+        print("Recommendations:")
         if len(eliminated_i_inventory) > 0:
-            print "\tOn-demand instances running in zones not supported by RIs. Migrate them to supported zones:"
-            print "\t" + str(eliminated_i_inventory)
-        print
+            print("\tOn-demand instances running in zones not supported by RIs. Migrate them to supported zones:")
+            print("\t" + str(eliminated_i_inventory))
+        print()
         if len(ri_imbalance) > 0:
-            print "\tOn-demand/RI imbalance detected!"
-            print "\tNegative numbers indicate additional RIs needed, positive ones indicate that RIs are underutilized and more instances can be launched:"
-            print "\t" + str(ri_imbalance)
-    print
+            print("\tOn-demand/RI imbalance detected!")
+            print("\tNegative numbers indicate additional RIs needed, positive ones indicate that RIs are underutilized and more instances can be launched:")
+            print("\t" + str(ri_imbalance))
+    print()
     # 3.7 print high-level optimization plan if one is possible, showing how many RIs need to be moved to which AZs
     if len(plan) == 0:
-        print "No RI redistribution is possible."
+        print("No RI redistribution is possible.")
     else:
-        print "RI Optimization possible! Plan: " + str(plan)
+        print("RI Optimization possible! Plan: " + str(plan))
         if optimize:
             if modifications_inflight:
-                print "Previous optimizations are still processing, new optimizations kicked off in DRY-RUN mode only!"
+                print("Previous optimizations are still processing, new optimizations kicked off in DRY-RUN mode only!")
             else:
-                print "Optimize option selected, optimizations kicked-off..."
+                print("Optimize option selected, optimizations kicked-off...")
         else:
-            print "Optimize flag not set, so optimizations kicked off in DRY-RUN mode only!"
+            print("Optimize flag not set, so optimizations kicked off in DRY-RUN mode only!")
 
-        print
+        print()
         # 3.8 finally, if optimizations were actually kicked off, list all modification ids, or fake ones in case of a dry run
-        print "Initiated optimizations:"
-        print modification_ids
+        print("Initiated optimizations:")
+        print(modification_ids)
 
     filename_safe_timestamp = str(time_now).replace(' ','_').replace(':', '-')
-    report_file_name = "riptimize_report_%s_%s.csv" % (region, filename_safe_timestamp)
+    report_file_name = f"riptimize_report_{region}_{filename_safe_timestamp}.csv"
 
-    csv_report(report_file_name, time_now, region, i_inventory_by_account, ri_inventory, clean_mismatch, plan, modification_ids)
-    print
-    print "CSV report written to %s" % report_file_name
+    # 4. publish metrics to CloudWatch in the background while the report is written and uploaded to S3
+    if publish_metrics:
+        executor = ThreadPoolExecutor(max_workers=1)
+        metrics_future = executor.submit(riptimize.publish_cw_metrics, ri_account_credentials, region, ri_surplus)
+
+    report = csv_report(report_file_name, time_now, region, i_inventory_by_account, ri_inventory, clean_mismatch, plan, modification_ids)
+    print()
+    print(f"CSV report written to {report_file_name}")
 
     if upload_report:
-        upload_report_to_s3(ri_account_credentials, report_file_name, s3_report_bucket)
-        print
-        print "Report uploaded to S3 as %s/%s of RI holding account %s" % (s3_report_bucket, report_file_name, ri_account_id)
+        upload_report_to_s3(ri_account_credentials, region, report_file_name, s3_report_bucket, report)
+        print()
+        print(f"Report uploaded to S3 as {s3_report_bucket}/{report_file_name} of RI holding account {ri_account_id}")
+
+    if publish_metrics:
+        metrics_future.result()
+        executor.shutdown()
+        print()
+        print(f"RI usage metrics published to CloudWatch namespace RI-usage-{region}")
 
-    print
-    print "Done"
+    print()
+    print("Done")
 
-# exapmle of generating a CSV report
+# exapmle of generating a CSV report, returns the report contents so they can be uploaded without reading the file back
 def csv_report(csv_file_name, time_now, region, i_inventory_by_account, ri_inventory, clean_mismatch, plan, modification_ids):
-    with open(csv_file_name, 'wb') as csv_file:
-        writer = csv.writer(csv_file)
-        writer.writerow(["Report for region %s at %s" % (region, str(time_now))])
-        # write instance inventory report
-        writer.writerow([])
-        writer.writerow(['Instance Inventory'])
-        writer.writerow(['Account ID', 'Instance Type', 'Availability Zone', 'Count'])
-        for account_id, inventory_for_account in i_inventory_by_account.items():
-            for (itype, az), count in inventory_for_account.items():
-                writer.writerow([account_id, itype, az, count])
-        # write RI inventory report
-        writer.writerow([])
-        writer.writerow(['RI Inventory'])
-        writer.writerow(['Instance Type', 'Availability Zone', 'Count'])
-        for (itype, az), count in ri_inventory.items():
-            writer.writerow([itype, az, count])
-        # write report on On-demand/RI inventory mismatches
-        writer.writerow([])
-        writer.writerow(['On-demand/RI inventory mismatches per each availability zone'])
-        writer.writerow(['Instance Type', 'Availability Zone', 'Diff'])
-        for (itype, az), count in clean_mismatch.items():
-            writer.writerow([itype, az, count])
-        # write optimization plan
-        writer.writerow([])
-        writer.writerow(['RI modification plan'])
-        writer.writerow(['Instance Type', 'Source AZ', 'Destination AZ', 'Count'])
-        for itype, source_az, dest_az, count in plan:
-            writer.writerow([itype, source_az, dest_az, count])
-        # write modification_ids
-        writer.writerow([])
-        writer.writerow(['Kicked off RI modifications'])
-        writer.writerow(['Modification ID'])
-        for modification_id in modification_ids:
-            writer.writerow([modification_id])
-
-
-def upload_report_to_s3(ri_account_credentials, report_file_name, s3_report_bucket):
-    access_key_id, secret_access_key = ri_account_credentials
-    s3 = boto.connect_s3(aws_access_key_id=access_key_id, aws_secret_access_key=secret_access_key)
-
-    # create bucket if does not exist
-    bucket = s3.lookup(s3_report_bucket)
-    if not bucket:
-        bucket = s3.create_bucket(s3_report_bucket)
-
-    # upload the report
-    key = bucket.new_key(report_file_name)
-    key.set_contents_from_filename(report_file_name)
-
-    s3.close()
+    rows = [[f"Report for region {region} at {time_now}"]]
+    # write instance inventory report
+    rows.append([])
+    rows.append(['Instance Inventory'])
+    rows.append(['Account ID', 'Instance Type', 'Availability Zone', 'Count'])
+    for account_id, inventory_for_account in i_inventory_by_account.items():
+        rows.extend([account_id, itype, az, count] for (itype, az), count in inventory_for_account.items())
+    # write RI inventory report
+    rows.append([])
+    rows.append(['RI Inventory'])
+    rows.append(['Instance Type', 'Availability Zone', 'Count'])
+    rows.extend([itype, az, count] for (itype, az), count in ri_inventory.items())
+    # write report on On-demand/RI inventory mismatches
+    rows.append([])
+    rows.append(['On-demand/RI inventory mismatches per each availability zone'])
+    rows.append(['Instance Type', 'Availability Zone', 'Diff'])
+    rows.extend([itype, az, count] for (itype, az), count in clean_mismatch.items())
+    # write optimization plan
+    rows.append([])
+    rows.append(['RI modification plan'])
+    rows.append(['Instance Type', 'Source AZ', 'Destination AZ', 'Count'])
+    rows.extend([itype, source_az, dest_az, count] for itype, source_az, dest_az, count in plan)
+    # write modification_ids
+    rows.append([])
+    rows.append(['Kicked off RI modifications'])
+    rows.append(['Modification ID'])
+    rows.extend([modification_id] for modification_id in modification_ids)
+
+    # stage the report in memory and write it out in one go
+    csv_buffer = io.StringIO(newline='')
+    csv.writer(csv_buffer).writerows(rows)
+    report = csv_buffer.getvalue()
+    with open(csv_file_name, 'w', newline='', buffering=1 << 20) as csv_file:
+        csv_file.write(report)
+    return report
+
+
+# S3 uploads of reports larger than this are split into parts that are uploaded in parallel
+S3_TRANSFER_CONFIG = TransferConfig(multipart_threshold=8 * 1024 * 1024, max_concurrency=8, use_threads=True)
+
+
+def s3_client(region, ri_account_credentials):
+    # share the session, connection settings and client cache riptimize uses
+    return riptimize.aws_client('s3', region, ri_account_credentials)
+
+
+def upload_report_to_s3(ri_account_credentials, region, report_file_name, s3_report_bucket, report):
+    s3 = s3_client(region, ri_account_credentials)
+    report_bytes = report.encode('utf-8')
+
+    # upload the report, optimistically assuming the bucket exists to save a round trip
+    try:
+        s3.upload_fileobj(io.BytesIO(report_bytes), s3_report_bucket, report_file_name, Config=S3_TRANSFER_CONFIG)
+    except botocore.exceptions.ClientError as e:
+        if e.response['Error']['Code'] != 'NoSuchBucket':
+            raise
+        # create bucket if does not exist and try again
+        if region == 'us-east-1':
+            s3.create_bucket(Bucket=s3_report_bucket)
+        else:
+            s3.create_bucket(Bucket=s3_report_bucket, CreateBucketConfiguration={'LocationConstraint': region})
+        s3.upload_fileobj(io.BytesIO(report_bytes), s3_report_bucket, report_file_name, Config=S3_TRANSFER_CONFIG)
 
 if __name__ == '__main__':
     main()
@@ -17,9 +17,38 @@ to migrate them to one of the 3 supported AZs. If a corresponding option
 modifications in order to migrate the RIs and thus increase RI
 utilization.
 """
+import sys
 import time
-import boto
-import boto.ec2
+import threading
+import functools
+import uuid
+from collections import Counter, defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import boto3
+import botocore.config
+
+# upper bound on the number of linked accounts queried concurrently
+MAX_INVENTORY_WORKERS = 32
+# upper bound on the number of RI modifications submitted concurrently
+MAX_MODIFICATION_WORKERS = 8
+# maximum number of metric data points CloudWatch accepts in a single PutMetricData call
+MAX_METRICS_PER_CALL = 20
+# maximum page size DescribeInstances accepts
+MAX_INSTANCES_PER_PAGE = 1000
+# maximum number of (region, credentials) combinations for which clients are kept open
+MAX_CACHED_CLIENTS = 256
+# number of seconds for which the instance inventory of an account is reused by subsequent riptimize() calls
+DEFAULT_INVENTORY_CACHE_TTL = 30
+
+# all AWS clients retry throttled calls with adaptive backoff and keep their pooled connections alive
+BOTO_CONFIG = botocore.config.Config(retries={'mode': 'adaptive', 'max_attempts': 10}, max_pool_connections=32, tcp_keepalive=True)
+
+# instance inventory cache keyed by (region, account_id), the values are tuples of (fetch_time, account_inventory)
+i_inventory_cache = {}
+# boto3 sessions are not thread safe, so clients are only ever created while holding this lock
+client_creation_lock = threading.Lock()
+# last RI surplus values published to CloudWatch keyed by (region, access_key_id)
+last_published_metrics = {}
 
 # TODO Idea: publish RI utilization metrics to CloudWatch so they can be
 #   viewed in the console
@@ -27,7 +56,7 @@ import boto.ec2
 #   logging purposes
 
 def riptimize(all_accounts, ri_account_credentials, region, optimize=False,
-              publish_metrics=True):
+              publish_metrics=True, inventory_cache_ttl=DEFAULT_INVENTORY_CACHE_TTL):
     """
     riptimize() accepts the following arguments:
 
@@ -50,7 +79,14 @@ def riptimize(all_accounts, ri_account_credentials, region, optimize=False,
                             is False by default
 
     publish_metrics -- When False, do not publish RI usage metrics to CloudWatch,
-                            True by default
+                            True by default. Only metrics whose values changed
+                            since the previous call are published
+
+    inventory_cache_ttl -- number of seconds for which the on-demand instance
+                            inventory fetched for an account is reused by
+                            subsequent calls instead of querying EC2 again,
+                            30 by default. Set to 0 to always fetch a fresh
+                            inventory
 
     and returns a large tuple consisting of the following information:
 
@@ -61,13 +97,15 @@ def riptimize(all_accounts, ri_account_credentials, region, optimize=False,
                             are the same as i_inventory above
 
     ri_inventory -- same as i_inventory but for RIs in the RI holding account,
-                            RIs in other accounts are ignored
+                            RIs in other accounts are ignored, and so are
+                            regional RIs since they are not bound to an AZ
 
-    supported_ri_zones -- a list of availability zones used by the RI holding
+    supported_ri_zones -- a frozenset of availability zones used by the RI holding
                             account, RIs can only move between these zones
 
-    processing_modifications -- a list of modification_ids of all previous RI
-                            modifications that are still in 'processing' state
+    processing_modifications -- a list of all previous RI modifications that are
+                            still in 'processing' state, as returned by
+                            DescribeReservedInstancesModifications API
 
     clean_mismatch -- a dict similar to i_inventory, except values are count
                             differences between the corresponding values of
@@ -97,9 +135,15 @@ def riptimize(all_accounts, ri_account_credentials, region, optimize=False,
                             modification IDs returned by
                             ModifyReservedInstances API, so these can be
                             tracked later on
+
+    ri_surplus -- a dict keyed by instance type with the RI surplus (or deficit)
+                            aggregated over all supported availability zones,
+                            i.e. the values published as CloudWatch metrics.
+                            Callers passing publish_metrics=False can hand it
+                            to publish_cw_metrics() themselves
     """
     # 1. get the inventory for on-demand instances running in all linked accounts
-    i_inventory_by_account = get_i_inventory_by_account(all_accounts, region)
+    i_inventory_by_account = get_i_inventory_by_account(all_accounts, region, inventory_cache_ttl)
     i_inventory = aggregate_inventory(i_inventory_by_account)
 
     # 2. get the RI inventory in the RI holding account, supported RI zones and any previous RI modifications that are still being processed
@@ -135,91 +179,154 @@ def riptimize(all_accounts, ri_account_credentials, region, optimize=False,
         publish_cw_metrics(ri_account_credentials, region, ri_surplus)
 
     # 10. finally, return all the collected information for generation of reports, logging, etc.
-    return (i_inventory, i_inventory_by_account, ri_inventory, supported_ri_zones, processing_modifications, clean_mismatch, recommendations, plan, modification_ids)
+    return (i_inventory, i_inventory_by_account, ri_inventory, supported_ri_zones, processing_modifications, clean_mismatch, recommendations, plan, modification_ids, ri_surplus)
 
     # TODO The function currently simply kicks off the proposed mofications without verifying whether they actually succeeded. Since the kinds of modifications
     # performed by this script are not likely to fail (no new RIs are purchased in the process), the modifications are extremely unlikely to fail, but nonetheless
     # monitoring the success of such modifications would be a recommended addition to the logic
 
 
-def get_i_inventory_by_account(all_accounts, region):
+# sessions are shared per credentials and clients are cached per region and credentials, so that repeated
+# riptimize() calls reuse their pooled keep-alive connections instead of paying for a new TLS handshake every time
+@functools.lru_cache(maxsize=MAX_CACHED_CLIENTS)
+def aws_session(credentials):
+    access_key_id, secret_access_key = credentials
+    return boto3.Session(aws_access_key_id=access_key_id, aws_secret_access_key=secret_access_key)
+
+
+@functools.lru_cache(maxsize=MAX_CACHED_CLIENTS)
+def aws_client(service, region, credentials):
+    # the clients themselves are thread safe and can be shared once created
+    with client_creation_lock:
+        return aws_session(credentials).client(service, region_name=region, config=BOTO_CONFIG)
+
+
+def ec2_client(region, credentials):
+    return aws_client('ec2', region, credentials)
+
+
+def cw_client(region, credentials):
+    return aws_client('cloudwatch', region, credentials)
+
+
+def get_i_inventory_by_account(all_accounts, region, cache_ttl=0):
     inventory_by_account = {}
+    now = time.monotonic()
+
+    # reuse inventories fetched less than cache_ttl seconds ago, only query EC2 for the rest
+    accounts_to_fetch = {}
     for account_id, credentials in all_accounts.items():
-        inventory_by_account[account_id] = get_account_i_inventory(credentials, region)
+        cached = i_inventory_cache.get((region, account_id))
+        if cached is not None and now - cached[0] < cache_ttl:
+            inventory_by_account[account_id] = dict(cached[1])
+        else:
+            accounts_to_fetch[account_id] = credentials
 
-    return inventory_by_account
+    if len(accounts_to_fetch) > 0:
+        # the calls are I/O bound, so query all linked accounts concurrently. Each account gets its own client
+        with ThreadPoolExecutor(max_workers=min(MAX_INVENTORY_WORKERS, len(accounts_to_fetch))) as executor:
+            futures = {}
+            for account_id, credentials in accounts_to_fetch.items():
+                future = executor.submit(get_account_i_inventory, credentials, region)
+                futures[future] = account_id
+            for future in as_completed(futures):
+                account_id = futures[future]
+                account_inventory = future.result()
+                if cache_ttl > 0:
+                    i_inventory_cache[(region, account_id)] = (now, account_inventory)
+                inventory_by_account[account_id] = dict(account_inventory)
+
+    # keep the accounts in the order they were given in
+    return {account_id: inventory_by_account[account_id] for account_id in all_accounts}
+
+
+def clear_inventory_cache():
+    # forces the next riptimize() call to fetch fresh instance inventories for all accounts
+    i_inventory_cache.clear()
 
 
 def get_account_i_inventory(credentials, region):
-    access_key_id, secret_access_key = credentials
-    conn = boto.ec2.connect_to_region(region, aws_access_key_id=access_key_id, aws_secret_access_key=secret_access_key)
-    account_inventory = {}
+    ec2 = ec2_client(region, credentials)
 
     # TODO should instances that are launching at this very moment be included in this report? Probably...
-    filters = {'instance-state-name' : 'running'}
-    for instance in conn.get_only_instances(filters=filters):
-        itype_and_az = instance.instance_type, instance.placement
-        if itype_and_az in account_inventory:
-            account_inventory[itype_and_az] += 1
-        else:
-            account_inventory[itype_and_az] = 1
+    filters = [{'Name': 'instance-state-name', 'Values': ['running']}]
+    # request the largest pages possible to minimize the number of round trips
+    pages = ec2.get_paginator('describe_instances').paginate(Filters=filters, PaginationConfig={'PageSize': MAX_INSTANCES_PER_PAGE})
+    account_inventory = Counter(intern_itype_and_az(instance['InstanceType'], instance['Placement']['AvailabilityZone'])
+                                for page in pages for reservation in page['Reservations'] for instance in reservation['Instances'])
+
+    return dict(account_inventory)
 
-    conn.close()
-    return account_inventory
+
+def intern_itype_and_az(itype, az):
+    # intern the key strings, so that all accounts share one string object per instance type and AZ
+    return sys.intern(itype), sys.intern(az)
 
 
 def aggregate_inventory(inventory_by_account):
-    i_inventory = {}
+    # update the running total in place, summing Counters would create a new Counter for every account
+    i_inventory = Counter()
     for account_inventory in inventory_by_account.values():
-        for itype_and_az, count in account_inventory.items():
-            if itype_and_az in i_inventory:
-                i_inventory[itype_and_az] += count
-            else:
-                i_inventory[itype_and_az] = count
-    return i_inventory
+        i_inventory.update(account_inventory)
+    return dict(i_inventory)
 
 
 def get_ri_inventory(ri_account_credentials, region):
-    access_key_id, secret_access_key = ri_account_credentials
-    conn = boto.ec2.connect_to_region(region, aws_access_key_id=access_key_id, aws_secret_access_key=secret_access_key)
+    ec2 = ec2_client(region, ri_account_credentials)
+
+    # the three calls below are independent of each other, so issue them concurrently. boto3 clients are thread
+    # safe and hand out a separate pooled HTTP connection to each request
+    with ThreadPoolExecutor(max_workers=3) as executor:
+        zones_future = executor.submit(ec2.describe_availability_zones)
+        modifications_future = executor.submit(get_processing_modifications, ec2)
+        ri_groups_future = executor.submit(get_active_ri_groups, ec2)
+        zones = zones_future.result()['AvailabilityZones']
+        processing_modifications = modifications_future.result()
+        ri_groups = ri_groups_future.result()
 
     # first, find out which availability zones are present in the RI account
-    supported_ri_zones = [] # just zone names
-    zones = conn.get_all_zones()
     for z in zones:
-        if z.state != 'available':
-            raise RuntimeError("Zone %s state is not available, i.e. %s" % z.name, z.state)
-        else:
-            supported_ri_zones.append(z.name)
+        if z['State'] != 'available':
+            raise RuntimeError("Zone %s state is not available, i.e. %s" % (z['ZoneName'], z['State']))
+    supported_ri_zones = frozenset(z['ZoneName'] for z in zones) # just zone names
 
-    # second, determine if there are still modifications that are being processed
-    mod_filters = {'status' : 'processing'}
-    processing_modifications = conn.describe_reserved_instances_modifications(filters=mod_filters)
+    # second, processing_modifications tells if there are still modifications that are being processed
 
     # and finally, compile the RI inventory for the RI account
-    ri_inventory = {}
+    ri_inventory = Counter()
 
-    ri_filters = {'state': 'active'} # possible RI Group states: active, retired, payment-pending, payment-failed
-    for ri_group in conn.get_all_reserved_instances(filters=ri_filters):
-        itype_and_az = ri_group.instance_type, ri_group.availability_zone
-        if itype_and_az in ri_inventory:
-            ri_inventory[itype_and_az] += ri_group.instance_count
-        else:
-            ri_inventory[itype_and_az] = ri_group.instance_count
+    for ri_group in ri_groups:
+        ri_inventory[intern_itype_and_az(ri_group['InstanceType'], ri_group['AvailabilityZone'])] += ri_group['InstanceCount']
+
+    return dict(ri_inventory), supported_ri_zones, processing_modifications
+
+
+def get_processing_modifications(ec2):
+    mod_filters = [{'Name': 'status', 'Values': ['processing']}]
+    pages = ec2.get_paginator('describe_reserved_instances_modifications').paginate(Filters=mod_filters)
+    return [modification for page in pages for modification in page['ReservedInstancesModifications']]
 
-    conn.close()
-    return ri_inventory, supported_ri_zones, processing_modifications
+
+def get_active_ri_groups(ec2):
+    ri_filters = [{'Name': 'state', 'Values': ['active']}, # possible RI Group states: active, retired, payment-pending, payment-failed
+                  # regional RIs apply to any AZ and cannot be moved between zones, so only zonal RIs are of interest
+                  {'Name': 'scope', 'Values': ['Availability Zone']}]
+    return ec2.describe_reserved_instances(Filters=ri_filters)['ReservedInstances']
 
 
 def compute_ri_mistmatch(ri_inventory, i_inventory):
-    mismatch = ri_inventory.copy()
+    mismatch = {}
 
+    # compute the differences in a single pass over each inventory, keeping only the entries that are actually out of balance
+    for itype_and_az, count in ri_inventory.items():
+        diff = count - i_inventory.get(itype_and_az, 0)
+        if diff != 0:
+            mismatch[itype_and_az] = diff
     for itype_and_az, count in i_inventory.items():
-        if itype_and_az not in mismatch:
-            mismatch[itype_and_az] = 0
-        mismatch[itype_and_az] -= count
+        if itype_and_az not in ri_inventory and count != 0:
+            mismatch[itype_and_az] = -count
 
-    return {itype_and_az: diff for itype_and_az, diff in mismatch.items() if diff != 0}
+    return mismatch
 
 
 def compute_ri_surplus(clean_mismatch):
@@ -234,101 +341,122 @@ def compute_ri_surplus(clean_mismatch):
 
 
 def greedy_distribution(mismatch):
-    # separate into recepients and donors
-    recepients = {}
-    donors = {}
-    for itype_and_az, diff in mismatch.items():
+    # separate into recepients and donors, bucketed by instance type so that only matching types are ever paired up
+    recepients_by_type = {}
+    donors_by_type = {}
+    for (itype, az), diff in mismatch.items():
         if diff < 0:
-            recepients[itype_and_az] = diff
+            recepients_by_type.setdefault(itype, []).append([az, -diff])
         elif diff > 0:
-            donors[itype_and_az] = diff
+            donors_by_type.setdefault(itype, []).append([az, diff])
 
     plan = []
 
-    for (recepient_itype, recepient_az), deficit in recepients.items():
-        for donor_itype_and_az, count in donors.items():
-            donor_itype, donor_az = donor_itype_and_az
-            if donor_itype == recepient_itype:
+    for itype, recepients in recepients_by_type.items():
+        donors = donors_by_type.get(itype, [])
+        donor_index = 0
+        for recepient_az, deficit in recepients:
+            while deficit > 0 and donor_index < len(donors):
+                donor = donors[donor_index]
+                donor_az, count = donor
                 # greedily compensate the deficit
-                move_count = min(abs(deficit), count)
+                move_count = min(deficit, count)
                 # update the plan with a new modification action
-                plan.append((donor_itype, donor_az, recepient_az, move_count))
-                # update the donor available count
-                if count == move_count:
-                    del donors[donor_itype_and_az]
-                else:
-                    donors[(donor_itype, donor_az)] -= move_count
+                plan.append((itype, donor_az, recepient_az, move_count))
+                # update the donor available count and move on to the next donor once this one is depleted
+                donor[1] -= move_count
+                if donor[1] == 0:
+                    donor_index += 1
                 # update deficit
-                deficit += move_count
-                if deficit >= 0:
-                    break
+                deficit -= move_count
 
     return plan
 
 
 def eliminate_unsupported_zones(mismatch, supported_ri_zones):
-    # eliminate entries for zones that are not in a supported list.
-    clean_mismatch = { itype_and_az : diff for itype_and_az, diff in mismatch.items() if itype_and_az[1] in supported_ri_zones }
-    eliminated_i_inventory = { itype_and_az : -diff for itype_and_az, diff in mismatch.items() if itype_and_az[1] not in supported_ri_zones }
+    # eliminate entries for zones that are not in a supported set, partitioning the mismatch in a single pass
+    clean_mismatch = {}
+    eliminated_i_inventory = {}
+    for itype_and_az, diff in mismatch.items():
+        if itype_and_az[1] in supported_ri_zones:
+            clean_mismatch[itype_and_az] = diff
+        else:
+            eliminated_i_inventory[itype_and_az] = -diff
     return clean_mismatch, eliminated_i_inventory
 
 
 def execute_plan(ri_account_credentials, region, plan, optimize):
-    access_key_id, secret_access_key = ri_account_credentials
-    conn = boto.ec2.connect_to_region(region, aws_access_key_id=access_key_id, aws_secret_access_key=secret_access_key)
-    ri_filters = {'state': 'active'}
-    ri_groups = conn.get_all_reserved_instances(filters=ri_filters)
+    ec2 = ec2_client(region, ri_account_credentials)
+    ri_groups = get_active_ri_groups(ec2)
+    # index RI groups by (instance_type, availability_zone), so each plan action does not rescan all of them
+    ri_groups_by_itype_and_az = defaultdict(deque)
+    for g in ri_groups:
+        ri_groups_by_itype_and_az[(g['InstanceType'], g['AvailabilityZone'])].append(g)
 
     modifications = {} # keyed by the source RI group
 
     for action in plan:
         itype, source_az, dest_az, count = action
-        # necessary to check g.instance_count > 0 below because the following code could decrement it down to 0
-        donor_groups = [g for g in ri_groups if g.instance_type == itype and g.availability_zone == source_az and g.instance_count > 0]
-        index = 0
-        while index < len(donor_groups) and count > 0:
-            donor_group = donor_groups[index]
-            move_count = min(count, donor_group.instance_count)
-            if donor_group.id not in modifications:
-                modifications[donor_group.id] = []
+        donor_groups = ri_groups_by_itype_and_az[(itype, source_az)]
+        while len(donor_groups) > 0 and count > 0:
+            donor_group = donor_groups[0]
+            # drop depleted groups, so that subsequent actions do not examine them again
+            if donor_group['InstanceCount'] == 0:
+                donor_groups.popleft()
+                continue
+            move_count = min(count, donor_group['InstanceCount'])
+            donor_group_id = donor_group['ReservedInstancesId']
+            if donor_group_id not in modifications:
+                modifications[donor_group_id] = []
             move_descriptor = (donor_group, dest_az, move_count)
-            modifications[donor_group.id].append(move_descriptor)
+            modifications[donor_group_id].append(move_descriptor)
             count -= move_count
-            donor_group.instance_count -= move_count
-            index += 1
+            donor_group['InstanceCount'] -= move_count
 
-    modification_ids = []
-
-    for modification in modifications.values():
-        modification_ids.append(move_reserved_instances(conn, modification, optimize))
+    # the modifications are independent of each other, so kick them off concurrently. map() preserves their order
+    with ThreadPoolExecutor(max_workers=MAX_MODIFICATION_WORKERS) as executor:
+        modification_ids = list(executor.map(lambda modification: move_reserved_instances(ec2, modification, optimize), modifications.values()))
 
-    conn.close()
     return modification_ids
 
 
-def move_reserved_instances(conn, move_descriptor_list, optimize):
+def move_reserved_instances(ec2, move_descriptor_list, optimize):
     assert len(move_descriptor_list) > 0
-    donor_group_id = move_descriptor_list[0][0].id # id of the donor group in the first tuple
+    donor_group_id = move_descriptor_list[0][0]['ReservedInstancesId'] # id of the donor group in the first tuple
     target_configurations = []
     for donor_group, dest_az, move_count,  in move_descriptor_list:
-        assert donor_group.id == donor_group_id # move_descriptor_list should contain one and the same RI group in all tuples
-        config = boto.ec2.reservedinstance.ReservedInstancesConfiguration(availability_zone = dest_az, instance_count = move_count, platform = "EC2-VPC")
+        assert donor_group['ReservedInstancesId'] == donor_group_id # move_descriptor_list should contain one and the same RI group in all tuples
+        config = {'AvailabilityZone': dest_az, 'InstanceCount': move_count, 'Platform': "EC2-VPC"}
         target_configurations.append(config)
-    if donor_group.instance_count > 0:
-        target_configurations.append(boto.ec2.reservedinstance.ReservedInstancesConfiguration(availability_zone = donor_group.availability_zone, instance_count = donor_group.instance_count, platform = "EC2-VPC"))
+    if donor_group['InstanceCount'] > 0:
+        target_configurations.append({'AvailabilityZone': donor_group['AvailabilityZone'], 'InstanceCount': donor_group['InstanceCount'], 'Platform': "EC2-VPC"})
 
     reserved_instance_ids = [donor_group_id]
     if optimize:
-        return conn.modify_reserved_instances(client_token = str(time.time()), reserved_instance_ids = reserved_instance_ids, target_configurations = target_configurations)
+        # a fresh token per modification keeps concurrent modifications apart and lets later runs retry failed ones,
+        # botocore's own retries resend the same request and so the same token
+        client_token = uuid.uuid4().hex
+        response = ec2.modify_reserved_instances(ClientToken = client_token, ReservedInstancesIds = reserved_instance_ids, TargetConfigurations = target_configurations)
+        return response['ReservedInstancesModificationId']
     else:
         return 'rimod-<DRY-RUN>'
 
 
 def publish_cw_metrics(ri_account_credentials, region, ri_surplus):
-    access_key_id, secret_access_key = ri_account_credentials
-    conn = boto.connect_cloudwatch(aws_access_key_id=access_key_id, aws_secret_access_key=secret_access_key)
-
-    for itype, surplus in ri_surplus.items():
-        conn.put_metric_data("RI-usage-%s" % region, "%s-available-RIs" % itype, surplus)
-
-    conn.close()
+    # only publish the metrics that changed since the previous call, so quiescent accounts make no API calls at all
+    last_published = last_published_metrics.setdefault((region, ri_account_credentials[0]), {})
+    # instance types that became balanced drop out of ri_surplus, their metrics need to go back to 0
+    current_surplus = {itype: 0 for itype in last_published}
+    current_surplus.update(ri_surplus)
+    changed_surplus = {itype: surplus for itype, surplus in current_surplus.items() if last_published.get(itype) != surplus}
+    if len(changed_surplus) == 0:
+        return
+
+    cw = cw_client(region, ri_account_credentials)
+
+    metric_data = [{'MetricName': "%s-available-RIs" % itype, 'Value': surplus, 'Unit': 'Count'} for itype, surplus in changed_surplus.items()]
+    # send the metrics in as few PutMetricData calls as possible
+    for start in range(0, len(metric_data), MAX_METRICS_PER_CALL):
+        cw.put_metric_data(Namespace="RI-usage-%s" % region, MetricData=metric_data[start:start + MAX_METRICS_PER_CALL])
+
+    last_published.update(changed_surplus)